@@ -1,47 +1,123 @@
+import asyncio
+import functools
 import json
 import logging
+import re
 from typing import Dict
-import ollama
+
+try:
+    import orjson
+
+    def _json_loads(s):
+        return orjson.loads(s)
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
 
 logger = logging.getLogger("flyme-chatbot-server")
 
+# Exact-match extraction cache shared across sessions: identical user input
+# against an identical slot state always yields the same extraction, so
+# repeat turns ("Paris", "15 Feb", "500 EUR") skip the LLM entirely.
+_EXTRACTION_CACHE: Dict[tuple, dict] = {}
+_EXTRACTION_CACHE_MAX = 4096
+
+# One shared client so every call reuses the same httpx connection pool
+# (HTTP keep-alive) instead of redoing TCP setup per request. Created
+# lazily: importing ollama is a noticeable chunk of cold-start time on
+# scale-to-zero deployments, and /v1/health shouldn't pay for it.
+_OLLAMA = None
+
+
+def _get_ollama():
+    global _OLLAMA
+    if _OLLAMA is None:
+        import ollama
+        _OLLAMA = ollama.AsyncClient(host="http://127.0.0.1:11434")
+    return _OLLAMA
+
+
+async def _embed_batch(texts: list) -> list:
+    """Embed several texts in one /api/embed roundtrip.
+
+    Used when indexing cache keys for a semantic tier on top of
+    _EXTRACTION_CACHE; batching is several times faster than looping
+    embeddings() per text. Falls back to sequential calls if the server
+    doesn't return the batch field.
+    """
+    response = await _get_ollama().embed(model="nomic-embed-text", input=texts)
+    embeddings = response.get("embeddings")
+    if embeddings is None:
+        # Server predates /api/embed batching: fall back to the legacy
+        # per-text embeddings() endpoint, whose response key differs.
+        embeddings = []
+        for text in texts:
+            single = await _get_ollama().embeddings(model="nomic-embed-text", prompt=text)
+            embeddings.append(single["embedding"])
+    return embeddings
+
 
 class FlyMeAgent:
+    # Fast-path confirmation classifier: the vast majority of answers to
+    # "Please confirm..." are trivial yes/no variants that don't need an LLM
+    # round-trip. Ambiguous messages still fall back to Ollama.
+    #
+    # Confirmation must match the WHOLE message (like _GREETING_RE): a
+    # prefix match would auto-confirm "yes, but change the date", which
+    # the LLM prompt explicitly rejects.
+    _CONFIRM_RE = re.compile(
+        r"^\s*(yes|yep|yeah|ok(ay)?|confirm(ed)?|sure|c'est bon|oui|proceed|👍|✅)[\s!.]*$",
+        re.IGNORECASE
+    )
+    # Rejection may stay prefix-anchored: "no, make it March" is still a
+    # rejection, and the worst case is only re-asking for confirmation.
+    _REJECT_RE = re.compile(
+        r"^\s*(no|nope|non|nah|wait|stop|cancel|change|modify|edit|wrong|incorrect)\b",
+        re.IGNORECASE
+    )
+    # Pure greetings/thanks carry no slot value — no point asking the LLM.
+    _GREETING_RE = re.compile(
+        r"^(hi|hello|hey|salut|bonjour|yo|thanks?|thx)\b[\s!.]*$",
+        re.IGNORECASE
+    )
+
+    # Collection priority and the question asked for each slot, shared by
+    # every call site instead of being rebuilt per request.
+    _SLOT_ORDER = ("or_city", "dst_city", "dep_date", "ret_date", "budget")
+    _QUESTIONS = {
+        "or_city": "What is your departure city?",
+        "dst_city": "What is your destination city?",
+        "dep_date": "When do you want to depart? (e.g., 2026-07-10)",
+        "ret_date": "When do you want to return? (e.g., 2026-07-15)",
+        "budget": "What is your maximum budget? (e.g., 500 EUR)"
+    }
+
     def __init__(self, session_id: str = "unknown"):
         self.session_id = session_id
-        self.slots = {
-            "or_city": None,
-            "dst_city": None,
-            "dep_date": None,
-            "ret_date": None,
-            "budget": None
-        }
+        self.slots = {k: None for k in self._SLOT_ORDER}
         self.status = "COLLECTING"
         self.last_question = "Hi! I'm the Fly Me assistant. Tell me your departure city, destination, dates, and max budget."
         self.awaiting_confirmation = False
-
-    # --------------------------
-    # Slot Helpers
-    # --------------------------
-    def _missing_slots(self):
-        return [k for k, v in self.slots.items() if v is None]
-
-    def _build_prompt(self, user_message: str) -> str:
-        prompt = f"""
-You are a Fly Me slot extractor. Year is 2026. Current date: January 27, 2026.
+        # Serialized slots are reused across turns until a slot changes.
+        self._slots_dirty = True
+        self._slots_json_cache = ""
+        # Rendered confirmation recap, reused across refused-confirmation turns.
+        self._cached_confirmation = None
+        # Static instruction block, built once. Keeping it identical across
+        # turns (and first in the message list) lets Ollama reuse its
+        # KV-cache for the whole prefix; only the short user message varies.
+        self._system_prompt = """You are a Fly Me slot extractor. Year is 2026. Current date: January 27, 2026.
 
 SLOTS DEFINITION:
 - "or_city" = origin/departure city
-- "dst_city" = destination city  
+- "dst_city" = destination city
 - "dep_date" = departure date (YYYY-MM-DD)
 - "ret_date" = return date (YYYY-MM-DD)
 - "budget" = max budget with currency
 
-CURRENT STATE:
-Already filled: {json.dumps(self.slots, indent=2)}
-Question asked: "{self.last_question}"
-User just said: "{user_message}"
-
 INSTRUCTIONS:
 1. Extract ONLY from user's message what answers the missing slots.
 2. NO guesses, NO defaults - only explicit values from user.
@@ -49,32 +125,65 @@ INSTRUCTIONS:
 4. Keep already filled slots UNCHANGED.
 5. Next priority: or_city→dst_city→dep_date→ret_date→budget.
 
-OUTPUT STRICT JSON:
-{{
-"updated_slots": {{"or_city": <value or null>, "dst_city": <value or null>, "dep_date": <value or null>, "ret_date": <value or null>, "budget": <value or null>}},
+OUTPUT STRICT JSON (complete, ending with }}):
+{
+"updated_slots": {"or_city": <value or null>, "dst_city": <value or null>, "dep_date": <value or null>, "ret_date": <value or null>, "budget": <value or null>},
 "next_missing": "<first missing slot or 'none'>",
 "next_question": "<natural question for next slot or empty string>"
-}}
+}"""
+
+    # --------------------------
+    # Slot Helpers
+    # --------------------------
+    def _missing_slots(self):
+        return [k for k in self._SLOT_ORDER if self.slots[k] is None]
+
+    def _slots_json(self) -> str:
+        if self._slots_dirty:
+            self._slots_json_cache = _json_dumps(self.slots)
+            self._slots_dirty = False
+        return self._slots_json_cache
+
+    def _build_prompt(self, user_message: str) -> str:
+        """Dynamic suffix only; the static instructions live in self._system_prompt."""
+        prompt = f"""CURRENT STATE:
+Already filled: {self._slots_json()}
+Question asked: "{self.last_question}"
+User just said: "{user_message}"
 """
         return prompt
 
-    def _call_ollama(self, prompt: str) -> dict:
+    async def _call_ollama(self, prompt: str) -> dict:
         """Call Ollama LLM safely"""
         try:
-            response = ollama.Client(host="http://127.0.0.1:11434").chat(
+            # Streaming avoids Ollama's non-streaming latency pathology;
+            # chunks are accumulated so callers still get one full response.
+            stream = await _get_ollama().chat(
                 model="llama3.1",
                 messages=[
-                    {"role": "system", "content": "Output ONLY complete valid JSON ending with }}."},
-                    {"role": "user", "content": prompt}
+                    {"role": "system", "content": self._system_prompt},
+                    {"role": "user", "content": prompt},
+                    # Seed the opening brace so the model doesn't spend a
+                    # decoded token on it; re-prepended below before parsing.
+                    {"role": "assistant", "content": "{"}
                 ],
                 format="json",
-                options={"temperature": 0.0, "num_predict": 500}
+                stream=True,
+                options={"temperature": 0.0, "num_predict": 120}
             )
-            raw_text = response["message"]["content"].strip()
-            # Repair truncated JSON
-            if not raw_text.endswith('}'):
-                raw_text += '}' * (raw_text.count('{') - raw_text.count('}'))
-            parsed = json.loads(raw_text)
+            raw_text = ""
+            async for chunk in stream:
+                raw_text += chunk["message"]["content"]
+            raw_text = raw_text.strip()
+            if not raw_text.startswith('{'):
+                raw_text = '{' + raw_text
+            try:
+                parsed = _json_loads(raw_text)
+            except ValueError:
+                # Repair truncated JSON: close the still-open braces.
+                # str.count runs in C; only this rare branch pays for it.
+                depth = raw_text.count('{') - raw_text.count('}')
+                parsed = _json_loads(raw_text + '}' * max(depth, 0))
             if "updated_slots" not in parsed:
                 raise ValueError("Missing 'updated_slots' key")
             if "next_missing" not in parsed:
@@ -83,33 +192,53 @@ OUTPUT STRICT JSON:
                 parsed["next_question"] = ""
             return parsed
         except Exception as e:
-            print(f"❌ LLM Call Error: {e}")
+            logger.error("LLM call error: %s", e)
             return self._fallback_response()
 
     def _fallback_response(self) -> dict:
         missing = self._missing_slots()
         next_slot = missing[0] if missing else "none"
-        questions = {
-            "or_city": "What is your departure city?",
-            "dst_city": "What is your destination city?",
-            "dep_date": "When do you want to depart? (YYYY-MM-DD format)",
-            "ret_date": "When do you want to return? (YYYY-MM-DD format)",
-            "budget": "What is your maximum budget?"
-        }
         return {
             "updated_slots": self.slots.copy(),
             "next_missing": next_slot,
-            "next_question": questions.get(next_slot, "")
+            "next_question": self._QUESTIONS.get(next_slot, ""),
+            "fallback": True
         }
 
     # --------------------------
     # 1️⃣ Collect Booking Details
     # --------------------------
-    def collect_booking_details(self, user_message: str) -> dict:
-        llm_result = self._call_ollama(self._build_prompt(user_message))
-        for k, v in llm_result["updated_slots"].items():
-            if v is not None:
-                self.slots[k] = v
+    def _is_trivial_message(self, user_message: str) -> bool:
+        """Empty/greeting messages with nothing extractable skip the LLM."""
+        stripped = user_message.strip()
+        if len(stripped) < 2:
+            return True
+        return bool(self._GREETING_RE.match(stripped)) and not any(self.slots.values())
+
+    async def collect_booking_details(self, user_message: str) -> dict:
+        if not self._is_trivial_message(user_message):
+            # Stringify slot values: the LLM can fill a slot with a
+            # list/dict under format="json", which would make the raw
+            # items unhashable. last_question is part of the key because
+            # it is interpolated into the prompt.
+            cache_key = (
+                frozenset((k, str(v)) for k, v in self.slots.items()),
+                self.last_question,
+                user_message.lower().strip()
+            )
+            llm_result = _EXTRACTION_CACHE.get(cache_key)
+            if llm_result is None:
+                llm_result = await self._call_ollama(self._build_prompt(user_message))
+                # Don't pin transient LLM failures in the cache.
+                if not llm_result.get("fallback"):
+                    if len(_EXTRACTION_CACHE) >= _EXTRACTION_CACHE_MAX:
+                        _EXTRACTION_CACHE.pop(next(iter(_EXTRACTION_CACHE)))
+                    _EXTRACTION_CACHE[cache_key] = llm_result
+            for k, v in llm_result["updated_slots"].items():
+                if v is not None:
+                    self.slots[k] = v
+                    self._slots_dirty = True
+                    self._cached_confirmation = None
 
         missing = self._missing_slots()
         complete = len(missing) == 0
@@ -120,14 +249,7 @@ OUTPUT STRICT JSON:
             return self.booking_confirmation()
         else:
             next_slot = missing[0]
-            questions = {
-                "or_city": "What is your departure city?",
-                "dst_city": "What is your destination city?",
-                "dep_date": "When do you want to depart? (e.g., 2026-07-10)",
-                "ret_date": "When do you want to return? (e.g., 2026-07-15)",
-                "budget": "What is your maximum budget? (e.g., 500 EUR)"
-            }
-            self.last_question = questions[next_slot]
+            self.last_question = self._QUESTIONS[next_slot]
             return {
                 "text": self.last_question,
                 "slots": self.slots,
@@ -140,7 +262,9 @@ OUTPUT STRICT JSON:
     # --------------------------
     def booking_confirmation(self) -> dict:
         """Ask user to confirm booking details"""
-        self.last_question = self._confirmation_message()
+        if self._cached_confirmation is None:
+            self._cached_confirmation = self._confirmation_message()
+        self.last_question = self._cached_confirmation
         return {
             "text": self.last_question,
             "slots": self.slots,
@@ -168,25 +292,30 @@ OUTPUT STRICT JSON:
     # --------------------------
     # Main entry
     # --------------------------
-    def process_message(self, user_message: str) -> dict:
+    async def process_message(self, user_message: str) -> dict:
         if self.awaiting_confirmation:
-            if self._llm_detect_confirmation(user_message):
+            if await self._llm_detect_confirmation(user_message):
                 return self.booking_confirmed()
             else:
-                # Log refusal
-                logger.warning(
-                    "Booking confirmation refused",
-                    extra={
-                        "json_fields": {
-                            "event_type": "confirmation_refused",
-                            "session_id": self.session_id
+                # Log refusal off the response path: the cloud handler can
+                # block on its queue, so hand the emit to a worker thread.
+                asyncio.get_running_loop().run_in_executor(
+                    None,
+                    functools.partial(
+                        logger.warning,
+                        "Booking confirmation refused",
+                        extra={
+                            "json_fields": {
+                                "event_type": "confirmation_refused",
+                                "session_id": self.session_id
+                            }
                         }
-                    }
+                    )
                 )
                 # Repose les détails
                 return self.booking_confirmation()
         else:
-            return self.collect_booking_details(user_message)
+            return await self.collect_booking_details(user_message)
 
     # --------------------------
     # Confirmation & Helpers
@@ -202,7 +331,12 @@ OUTPUT STRICT JSON:
             f"Please confirm if everything is correct by replying 'yes' or 'confirm'."
         )
 
-    def _llm_detect_confirmation(self, user_message: str) -> bool:
+    async def _llm_detect_confirmation(self, user_message: str) -> bool:
+        # Trivial confirmations/rejections never reach the LLM.
+        if self._CONFIRM_RE.match(user_message):
+            return True
+        if self._REJECT_RE.match(user_message):
+            return False
         prompt = f"""
 You are a confirmation intent classifier.
 
@@ -223,17 +357,25 @@ OUTPUT STRICT JSON ONLY:
 {{"confirmed": true | false}}
 """
         try:
-            response = ollama.Client(host="http://127.0.0.1:11434").chat(
+            stream = await _get_ollama().chat(
                 model="llama3.1",
                 messages=[
                     {"role": "system", "content": "Output ONLY valid JSON."},
-                    {"role": "user", "content": prompt}
+                    {"role": "user", "content": prompt},
+                    {"role": "assistant", "content": "{"}
                 ],
                 format="json",
-                options={"temperature": 0.0, "num_predict": 50}
+                stream=True,
+                options={"temperature": 0.0, "num_predict": 8}
             )
-            parsed = json.loads(response["message"]["content"].strip())
+            raw_text = ""
+            async for chunk in stream:
+                raw_text += chunk["message"]["content"]
+            raw_text = raw_text.strip()
+            if not raw_text.startswith('{'):
+                raw_text = '{' + raw_text
+            parsed = _json_loads(raw_text)
             return bool(parsed.get("confirmed", False))
         except Exception as e:
-            print(f"⚠️ Confirmation LLM error: {e}")
+            logger.warning("Confirmation LLM error: %s", e)
             return False
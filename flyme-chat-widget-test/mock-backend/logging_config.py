@@ -6,15 +6,14 @@ Supporte Google Cloud Logging et OpenTelemetry pour Cloud Trace
 import logging
 import logging.config
 import os
+import re
 import sys
-from pythonjsonlogger import jsonlogger
-import google.cloud.logging
 from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.semconv.resource import ResourceAttributes
+
+# Les imports lourds (google.cloud.logging, SDK OpenTelemetry, exporteur
+# Cloud Trace, pythonjsonlogger) sont faits paresseusement dans les
+# méthodes setup_* : ils dominent le cold start sur Cloud Run et ne
+# servent à rien tant que le logging cloud n'est pas initialisé.
 
 
 class GoogleCloudLoggingConfig:
@@ -36,6 +35,9 @@ class GoogleCloudLoggingConfig:
     def setup_cloud_logging(self) -> logging.Logger:
         """Configure Google Cloud Logging avec format structuré"""
         try:
+            import google.cloud.logging
+            from pythonjsonlogger import jsonlogger
+
             # Initialiser le client Cloud Logging
             client = google.cloud.logging.Client(project=self.project_id)
             
@@ -58,6 +60,11 @@ class GoogleCloudLoggingConfig:
             # Supprimer les handlers existants pour éviter les doublons
             root_logger.handlers.clear()
             root_logger.addHandler(handler)
+
+            # Les clients HTTP internes ne doivent pas repasser par le
+            # handler cloud (bruit + risque de boucle d'export)
+            for noisy in ("urllib3", "httpx", "google.cloud.logging_v2"):
+                logging.getLogger(noisy).propagate = False
             
             # Ajouter un handler console pour le développement local
             if self.environment == "development":
@@ -91,6 +98,12 @@ class GoogleCloudLoggingConfig:
     def setup_cloud_trace(self) -> trace.Tracer:
         """Configure OpenTelemetry avec Cloud Trace exporter"""
         try:
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+            from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.semconv.resource import ResourceAttributes
+
             # Définir les métadonnées du service
             resource = Resource.create({
                 ResourceAttributes.SERVICE_NAME: self.service_name,
@@ -103,9 +116,18 @@ class GoogleCloudLoggingConfig:
             tracer_provider = TracerProvider(resource=resource)
             
             # Ajouter l'exporteur Cloud Trace
+            # Batch explicite : file à sa taille par défaut (2048), mais
+            # lots réduits à 256 (défaut : 512) et flush toutes les 2s au
+            # lieu de 5s, pour des exports plus petits et plus réguliers
+            # sous rafale
             cloud_trace_exporter = CloudTraceSpanExporter(project_id=self.project_id)
             tracer_provider.add_span_processor(
-                BatchSpanProcessor(cloud_trace_exporter)
+                BatchSpanProcessor(
+                    cloud_trace_exporter,
+                    max_queue_size=2048,
+                    max_export_batch_size=256,
+                    schedule_delay_millis=2000
+                )
             )
             
             # Définir le tracer provider global
@@ -127,21 +149,35 @@ class GoogleCloudLoggingConfig:
 # ✨ Filtre pour masquer les données sensibles
 class SensitiveDataFilter(logging.Filter):
     """Filtre pour masquer les données sensibles dans les logs"""
-    
-    import re
-    
-    # Patterns pour identifier les données sensibles
-    PATTERNS = {
-        'credit_card': re.compile(r'\b\d{4}[-\s]?\d{4}[-\s]?\d{4}[-\s]?\d{4}\b'),
-        'email': re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'),
-        'api_key': re.compile(r'(api[_-]?key|apikey|token)[\s:=]+[\w\-]+', re.IGNORECASE)
-    }
-    
+
+    # Pré-filtre bon marché : la grande majorité des messages ne contiennent
+    # ni chiffre, ni @, ni mot-clé sensible — inutile de lancer les regex
+    # coûteuses dans ce cas
+    _FAST_RE = re.compile(r'[@\d]|api|token|key', re.IGNORECASE)
+
+    # Patterns combinés en une seule alternation : un seul passage sur le
+    # message au lieu d'un scan par pattern
+    _REDACT_RE = re.compile(
+        r'\b\d{4}[-\s]?\d{4}[-\s]?\d{4}[-\s]?\d{4}\b'          # credit_card
+        r'|\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'  # email
+        r'|(?:api[_-]?key|apikey|token)[\s:=]+[\w\-]+',           # api_key
+        re.IGNORECASE
+    )
+
     def filter(self, record):
         """Masquer les données sensibles dans le message de log"""
-        if isinstance(record.msg, str):
-            for pattern_name, pattern in self.PATTERNS.items():
-                record.msg = pattern.sub('[REDACTED]', record.msg)
+        # Travailler sur le message rendu (msg % args) : pour les logs
+        # paresseux les données sensibles sont dans record.args, pas dans
+        # le format string
+        message = record.getMessage()
+        if not self._FAST_RE.search(message):
+            return True
+        redacted = self._REDACT_RE.sub('[REDACTED]', message)
+        if redacted != message:
+            # Ne réécrire le record que si quelque chose a été masqué,
+            # pour ne pas perturber les handlers suivants inutilement
+            record.msg = redacted
+            record.args = None
         return True
 
 
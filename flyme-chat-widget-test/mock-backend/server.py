@@ -1,13 +1,20 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
 from pathlib import Path
-from typing import Dict
+import gzip
+import hashlib
+import os
+import re
+import threading
 import uuid
 import logging
 
+from cachetools import TTLCache
+
 from agent import FlyMeAgent
 
 # ============================================================
@@ -16,9 +23,16 @@ from agent import FlyMeAgent
 
 app = FastAPI(
     title="Fly Me Flight Booking API",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson serializes straight to bytes, several times faster than the
+    # stdlib encoder behind the default JSONResponse.
+    default_response_class=ORJSONResponse
 )
 
+# Compress JSON responses over 1KB (long bot replies, flight listings);
+# level 5 trades a little ratio for low CPU.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # ⚠️ Restreindre en production
@@ -31,23 +45,73 @@ app.add_middleware(
 # GOOGLE CLOUD LOGGING
 # ============================================================
 
+# Skip the getpid()/current_thread() lookups logging does per record;
+# none of these fields end up in our structured payloads.
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
+gcloud_handler = None
+_HANDLER_INSTALLED = False
+
 try:
     import google.cloud.logging
-    from google.cloud.logging_v2.handlers.transports import SyncTransport
+    from google.cloud.logging_v2.handlers.transports import BackgroundThreadTransport
 
     log_client = google.cloud.logging.Client()
     gcloud_handler = log_client.get_default_handler()
-    gcloud_handler.transport = SyncTransport(
+    # Batching transport: log writes leave the request thread and are
+    # flushed by a worker either every 100 entries or every 0.5s,
+    # instead of one blocking RPC per record.
+    gcloud_handler.transport = BackgroundThreadTransport(
         log_client,
-        name="flyme-chatbot-server"
+        name="flyme-chatbot-server",
+        grace_period=5.0,
+        batch_size=100,
+        max_latency=0.5
     )
 
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)
+    # The default client multiplexes every WriteLogEntries call over a
+    # single gRPC HTTP/2 channel, so concurrent requests head-of-line
+    # block each other. Rebuild the logging API on a channel that uses
+    # gRPC's local subchannel pool. Best-effort: library internals, so
+    # any failure just keeps the stock channel.
+    try:
+        from google.cloud.logging_v2 import _gapic
+        from google.cloud.logging_v2.services.logging_service_v2 import (
+            LoggingServiceV2Client,
+        )
+        from google.cloud.logging_v2.services.logging_service_v2.transports import (
+            LoggingServiceV2GrpcTransport,
+        )
 
-    if not any(isinstance(h, type(gcloud_handler)) for h in root_logger.handlers):
-        root_logger.addHandler(gcloud_handler)
+        pooled_channel = LoggingServiceV2GrpcTransport.create_channel(
+            credentials=log_client._credentials,
+            options=[("grpc.use_local_subchannel_pool", 1)],
+        )
+        pooled_transport = LoggingServiceV2GrpcTransport(
+            credentials=log_client._credentials,
+            channel=pooled_channel,
+        )
+        log_client._logging_api = _gapic._LoggingAPI(
+            LoggingServiceV2Client(transport=pooled_transport),
+            log_client,
+        )
+    except Exception as pool_error:
+        logging.warning(f"⚠️ gRPC channel pool tuning skipped: {pool_error}")
+
+    # Attach the cloud handler to the app logger only (propagation off):
+    # each record then walks one handler list instead of also climbing to
+    # the root, and the install guard is a flag instead of an isinstance
+    # scan over existing handlers.
+    if not _HANDLER_INSTALLED:
+        app_logger = logging.getLogger("flyme-chatbot-server")
+        app_logger.setLevel(logging.INFO)
+        app_logger.addHandler(gcloud_handler)
+        app_logger.propagate = False
+        _HANDLER_INSTALLED = True
 
+    logging.basicConfig(level=logging.INFO)
     logging.info("✅ Google Cloud Logging connected")
 
 except Exception as e:
@@ -56,18 +120,74 @@ except Exception as e:
 
 logger = logging.getLogger("flyme-chatbot-server")
 
+# Per-event json_fields templates built once; call sites extend them with
+# dict-merge (base | {...}), which bulk-copies the pre-hashed table
+# instead of re-hashing the constant keys on every request.
+_BASE_CHAT_REQUEST = {"event_type": "chat_request"}
+_BASE_CONFIRMATION_REFUSED = {"event_type": "confirmation_refused"}
+_BASE_FALLBACK = {"event_type": "fallback"}
+_BASE_PROCESSING_ERROR = {"event_type": "processing_error"}
+
+# Fallback phrases fused into one case-insensitive scan — no .lower()
+# copies of the full response text and a single pass instead of one per
+# phrase.
+_FALLBACK_RE = re.compile(r"\b(sorry|don'?t understand)\b", re.IGNORECASE)
+
 # ============================================================
 # PATH CONFIG
 # ============================================================
 
 BASE_DIR = Path(__file__).resolve().parent
 PUBLIC_DIR = (BASE_DIR.parent / "public").resolve()
+# Resolved once; building the PosixPath per request is pure allocation.
+INDEX_PATH = str(PUBLIC_DIR / "index.html")
+
+# index.html is immutable for the process lifetime: loaded once at
+# startup and served from memory with an ETag, instead of re-stat/re-read
+# per hit.
+INDEX_BYTES = None
+INDEX_GZ = None
+INDEX_ETAG = ""
 
 # ============================================================
 # SESSION STORAGE (IN MEMORY)
 # ============================================================
 
-sessions: Dict[str, FlyMeAgent] = {}
+class ShardedSessionMap:
+    """Session store sharded into per-bucket TTL caches.
+
+    Each bucket keeps its own lock, so sessions hashed to different
+    buckets never serialize on one global lock. Buckets stay bounded and
+    idle-evicted (30 minutes without a message drops the session).
+    """
+
+    def __init__(self, shards: int = 16, maxsize: int = 10_000, ttl: int = 1800):
+        # Power-of-two shard count so the index is a cheap mask.
+        self._shards = shards
+        self._maps = [
+            TTLCache(maxsize=max(maxsize // shards, 1), ttl=ttl)
+            for _ in range(shards)
+        ]
+        self._locks = [threading.Lock() for _ in range(shards)]
+
+    def _index(self, session_id: str) -> int:
+        return hash(session_id) & (self._shards - 1)
+
+    def get_or_create(self, session_id: str, factory):
+        """Return (agent, created); at most one caller ever creates."""
+        idx = self._index(session_id)
+        with self._locks[idx]:
+            agent = self._maps[idx].get(session_id)
+            created = agent is None
+            if created:
+                agent = self._maps[idx][session_id] = factory()
+            return agent, created
+
+    def __len__(self):
+        return sum(len(m) for m in self._maps)
+
+
+sessions = ShardedSessionMap()
 
 # ============================================================
 # MODELS
@@ -83,6 +203,23 @@ class ChatMessage(BaseModel):
 
 @app.on_event("startup")
 async def startup_event():
+    global INDEX_BYTES, INDEX_GZ, INDEX_ETAG
+
+    # The default anyio threadpool (40 tokens) serves StaticFiles IO and
+    # any sync work offloaded from handlers; widen it so IO-bound threads
+    # don't queue behind each other under load.
+    import anyio
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 64
+
+    try:
+        with open(INDEX_PATH, "rb") as f:
+            INDEX_BYTES = f.read()
+        # Compressed once here: the asset is immutable for the process
+        # lifetime, so per-request middleware compression would be waste.
+        INDEX_GZ = gzip.compress(INDEX_BYTES, compresslevel=6)
+        INDEX_ETAG = hashlib.blake2b(INDEX_BYTES, digest_size=8).hexdigest()
+    except OSError as e:
+        logger.warning("Could not preload index.html: %s", e)
 
     logger.info(
         "Server startup",
@@ -90,22 +227,97 @@ async def startup_event():
             "json_fields": {
                 "event_type": "server_startup",
                 "base_dir": str(BASE_DIR),
-                "public_dir": str(PUBLIC_DIR)
+                "public_dir": str(PUBLIC_DIR),
+                # Answered from the preload above — no extra stat call.
+                "index_exists": INDEX_BYTES is not None
             }
         }
     )
 
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Drain the background logging transport so buffered entries aren't
+    # lost on SIGTERM.
+    if gcloud_handler is not None:
+        gcloud_handler.flush()
+
 # ============================================================
 # ROUTES
 # ============================================================
 
+class ZeroCopyFileResponse(FileResponse):
+    """FileResponse using the ASGI http.response.zerocopysend extension.
+
+    When the ASGI server advertises the extension, the file goes out via
+    os.sendfile(2) — no user-space copies of the body. Otherwise falls
+    back to Starlette's chunked read/send path.
+    """
+
+    @staticmethod
+    def _client_accepts_gzip(scope) -> bool:
+        for name, value in scope.get("headers", []):
+            if name == b"accept-encoding" and b"gzip" in value:
+                return True
+        return False
+
+    async def __call__(self, scope, receive, send):
+        # GZipMiddleware's responder only understands http.response.start
+        # and http.response.body and silently drops anything else, so a
+        # zerocopysend message would hang the request. When the client
+        # accepts gzip (i.e. the middleware will wrap this send), stay on
+        # the standard path.
+        if (
+            "http.response.zerocopysend" not in scope.get("extensions", {})
+            or self._client_accepts_gzip(scope)
+        ):
+            await super().__call__(scope, receive, send)
+            return
+        fd = os.open(self.path, os.O_RDONLY)
+        sent = False
+        try:
+            self.set_stat_headers(os.fstat(fd))
+            await send({
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            })
+            # After this send the server owns the fd and closes it.
+            await send({
+                "type": "http.response.zerocopysend",
+                "file": fd,
+                "more_body": False,
+            })
+            sent = True
+        finally:
+            if not sent:
+                os.close(fd)
+
+
+def _index_response(request: Request) -> Response:
+    if INDEX_BYTES is None:
+        # Preload failed; fall back to serving from disk.
+        return ZeroCopyFileResponse(INDEX_PATH)
+    if request.headers.get("if-none-match") == INDEX_ETAG:
+        return Response(status_code=304, headers={"ETag": INDEX_ETAG})
+    headers = {
+        "ETag": INDEX_ETAG,
+        "Cache-Control": "public, max-age=60",
+        "Vary": "Accept-Encoding"
+    }
+    if INDEX_GZ is not None and "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(INDEX_GZ, media_type="text/html", headers=headers)
+    return Response(INDEX_BYTES, media_type="text/html", headers=headers)
+
+
 @app.get("/")
-async def serve_index():
-    return FileResponse(PUBLIC_DIR / "index.html")
+async def serve_index(request: Request):
+    return _index_response(request)
 
 @app.get("/index.html")
-async def serve_index_file():
-    return FileResponse(PUBLIC_DIR / "index.html")
+async def serve_index_file(request: Request):
+    return _index_response(request)
 
 
 @app.post("/v1/chat/message")
@@ -116,58 +328,25 @@ async def chat_message(msg: ChatMessage):
         # SESSION ID SAFETY
         # ===================================================
         session_id = msg.session_id
+        # Evaluated once per request: when INFO is disabled, none of the
+        # json_fields dicts below are even built.
+        log_info = logger.isEnabledFor(logging.INFO)
 
-        if not session_id or session_id == "unknown":
-            session_id = str(uuid.uuid4())
-
-            logger.info(
-                "Session auto-generated",
-                extra={
-                    "json_fields": {
-                        "event_type": "session_auto_created",
-                        "session_id": session_id
-                    }
-                }
-            )
-
-        # ===================================================
-        # USER MESSAGE LOG
-        # ===================================================
-        logger.info(
-            "User message received",
-            extra={
-                "json_fields": {
-                    "event_type": "user_message",
-                    "session_id": session_id,
-                    "message_length": len(msg.text),
-                    "message_preview": msg.text[:100]
-                }
-            }
-        )
+        session_auto_created = not session_id or session_id == "unknown"
+        if session_auto_created:
+            session_id = uuid.uuid4().hex
 
         # ===================================================
         # SESSION CREATION
         # ===================================================
-        if session_id not in sessions:
-            sessions[session_id] = FlyMeAgent()
-
-            logger.info(
-                "Session created",
-                extra={
-                    "json_fields": {
-                        "event_type": "session_created",
-                        "session_id": session_id,
-                        "active_sessions": len(sessions)
-                    }
-                }
-            )
-
-        agent = sessions[session_id]
+        agent, created = sessions.get_or_create(
+            session_id, lambda: FlyMeAgent(session_id)
+        )
 
         # ===================================================
         # PROCESS MESSAGE
         # ===================================================
-        response = agent.process_message(msg.text)
+        response = await agent.process_message(msg.text)
 
         # ===================================================
         # BUSINESS EVENTS
@@ -176,8 +355,7 @@ async def chat_message(msg: ChatMessage):
             logger.warning(
                 "Booking confirmation refused",
                 extra={
-                    "json_fields": {
-                        "event_type": "confirmation_refused",
+                    "json_fields": _BASE_CONFIRMATION_REFUSED | {
                         "session_id": session_id
                     }
                 }
@@ -186,47 +364,58 @@ async def chat_message(msg: ChatMessage):
         # ===================================================
         # FALLBACK DETECTION
         # ===================================================
-        is_fallback = (
-            "sorry" in response["text"].lower()
-            or "don't understand" in response["text"].lower()
-        )
+        is_fallback = bool(_FALLBACK_RE.search(response["text"]))
 
         if is_fallback:
+            # Slice only when over the cap — typical messages fit and the
+            # alias avoids a copy retained in the log queue until flush.
+            user_input = msg.text if len(msg.text) <= 300 else msg.text[:300]
+            bot_text = response["text"]
+            if len(bot_text) > 300:
+                bot_text = bot_text[:300]
             logger.warning(
                 "Fallback triggered",
                 extra={
-                    "json_fields": {
-                        "event_type": "fallback",
+                    "json_fields": _BASE_FALLBACK | {
                         "session_id": session_id,
-                        "user_input": msg.text[:300],
-                        "bot_response": response["text"][:300]
+                        "user_input": user_input,
+                        "bot_response": bot_text
                     }
                 }
             )
 
         # ===================================================
-        # BOT RESPONSE LOG
+        # REQUEST SUMMARY LOG
         # ===================================================
-        logger.info(
-            "Bot response generated",
-            extra={
-                "json_fields": {
-                    "event_type": "bot_response",
-                    "session_id": session_id,
-                    "is_fallback": is_fallback,
-                    "is_complete": response["complete"],
-                    "missing_info_count": len(response["missing_info"]),
-                    "response_length": len(response["text"]),
+        # One structured record per request instead of one per step:
+        # 5x fewer LogEntry serializations and batch slots.
+        if log_info:
+            logger.info(
+                "chat_request",
+                extra={
+                    "json_fields": _BASE_CHAT_REQUEST | {
+                        "session_id": session_id,
+                        "session_auto_created": session_auto_created,
+                        "session_created": created,
+                        "active_sessions": len(sessions),
+                        "message_length": len(msg.text),
+                        "message_preview": (
+                            msg.text if len(msg.text) <= 100 else msg.text[:100]
+                        ),
+                        "is_fallback": is_fallback,
+                        "is_complete": response["complete"],
+                        "missing_info_count": len(response["missing_info"]),
+                        "response_length": len(response["text"]),
+                    }
                 }
-            }
-        )
+            )
 
         # ===================================================
         # RETURN API RESPONSE
         # ===================================================
         return {
             "session_id": session_id,
-            "reply_id": str(uuid.uuid4()),
+            "reply_id": uuid.uuid4().hex,
             "text": response["text"],
             "slots": response["slots"],
             "missing_info": response["missing_info"],
@@ -239,8 +428,7 @@ async def chat_message(msg: ChatMessage):
             "Chat processing error",
             exc_info=True,
             extra={
-                "json_fields": {
-                    "event_type": "processing_error",
+                "json_fields": _BASE_PROCESSING_ERROR | {
                     "session_id": msg.session_id,
                     "error": str(e)
                 }
@@ -261,3 +449,31 @@ async def health():
 # ============================================================
 
 app.mount("/", StaticFiles(directory=str(PUBLIC_DIR)), name="static")
+
+# ============================================================
+# ENTRYPOINT
+# ============================================================
+
+if __name__ == "__main__":
+    import multiprocessing
+    import sys
+    import uvicorn
+
+    # uvloop + httptools roughly double request/s over the default
+    # asyncio/h11 combo for small-JSON endpoints, and one worker per core
+    # sidesteps the GIL. Sessions live per process: run multi-worker only
+    # behind a load balancer with sticky routing on session_id (or move
+    # sessions to Redis).
+    options = {
+        "host": "0.0.0.0",
+        "port": 8000,
+        "limit_concurrency": 1024,
+        "backlog": 2048,
+    }
+    if sys.platform != "win32":
+        options.update(
+            loop="uvloop",
+            http="httptools",
+            workers=multiprocessing.cpu_count(),
+        )
+    uvicorn.run("server:app", **options)